@@ -1,14 +1,56 @@
-from flask import Flask, jsonify, request
+import atexit
+import base64
+import datetime
+import hashlib
+import io
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import quote
+
+import exifread
+import numpy as np
+import orjson
+import requests
+from flask import Flask, jsonify, make_response, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from geopy.geocoders import Nominatim
+from google.api_core.exceptions import NotFound
+from google.cloud import storage, vision
+from sentence_transformers import SentenceTransformer
+from usearch.index import Index
+
 from search import search_bp
 
+class ORJSONProvider(JSONProvider):
+    # Serialize jsonify()/request.get_json() through orjson's C encoder
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 ALLOWED_ORIGINS = [
     "https://photo-portfolio-cloud.windsurf.build",
     "https://photoportfolio-app.windsurf.build",
     "https://photo-frontend-839093975626.us-central1.run.app"
 ]
-CORS(app, origins=ALLOWED_ORIGINS, resources={r"/api/*": {"origins": ALLOWED_ORIGINS}}, allow_headers='Content-Type', expose_headers='Content-Type', supports_credentials=True)
+CORS(app, origins=ALLOWED_ORIGINS, resources={r"/api/*": {"origins": ALLOWED_ORIGINS}}, methods=['GET', 'POST', 'OPTIONS', 'DELETE'], allow_headers=['Content-Type', 'Authorization'], expose_headers=['Content-Type', 'X-Next-Cursor'], supports_credentials=True)
 app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024  # 32 MB limit (Cloud Run/App Engine max)
 
 def get_cors_origin():
@@ -48,25 +90,23 @@ def handle_photos():
         photos.append(photo)
         return jsonify(photo), 201
 
-from werkzeug.utils import secure_filename
-from google.cloud import storage
+# Precompiled filename sanitizer (replaces werkzeug's secure_filename)
+_SAFE = re.compile(r'[^A-Za-z0-9._-]+')
 
-# Print DB path on startup
-DB_PATH = os.environ.get('DB_PATH', 'metadata.db')
-print(f"[PHOTO-PORTFOLIO] Using DB file: {os.path.abspath(DB_PATH)}")
-logging.info(f"Using DB file: {os.path.abspath(DB_PATH)}")
+def _safe(s):
+    return _SAFE.sub('_', s).strip('._')[:255] or 'file'
 
-from PIL import Image
-import exifread
-from geopy.geocoders import Nominatim
-from google.cloud import vision
-import io
+# Log DB path on startup
+DB_PATH = os.environ.get('DB_PATH', 'metadata.db')
+logging.info("Using DB file: %s", os.path.abspath(DB_PATH))
 
 # --- Location Tag Utilities ---
-def extract_gps_from_exif(image_path):
+# Shared HTTP session so photo downloads reuse pooled TCP/TLS connections
+_http = requests.Session()
+
+def extract_gps_from_exif(image_bytes):
     try:
-        with open(image_path, 'rb') as f:
-            tags = exifread.process_file(f, details=False)
+        tags = exifread.process_file(io.BytesIO(image_bytes), details=False)
         gps_lat = tags.get('GPS GPSLatitude')
         gps_lat_ref = tags.get('GPS GPSLatitudeRef')
         gps_lon = tags.get('GPS GPSLongitude')
@@ -107,214 +147,406 @@ def google_vision_landmark(image_bytes):
         pass
     return None
 
+_UNTAGGED_WHERE = "(location_tag IS NULL OR location_tag = '' OR location_tag = 'null')"
+UNTAGGED_COUNT_SQL = f'SELECT COUNT(*) FROM photos WHERE {_UNTAGGED_WHERE}'
+# Windows are planned from untagged ids only (served by idx_photos_untagged), so a pass
+# never walks id ranges that are already tagged or deleted; windows stay disjoint
+# [lo, hi] id ranges rather than LIMIT/OFFSET over the untagged set, which shrinks
+# as concurrent batches commit and would shift sibling windows
+UNTAGGED_IDS_SQL = f'SELECT id FROM photos WHERE id > ? AND {_UNTAGGED_WHERE} ORDER BY id LIMIT ?'
+UNTAGGED_BATCH_SQL = f'SELECT id, url FROM photos WHERE id >= ? AND id <= ? AND {_UNTAGGED_WHERE} ORDER BY id'
+
+# Upper bound on batches per /api/annotate-locations/batch call (and windows per plan), to keep requests short
+ANNOTATE_MAX_BATCHES = 20
+
+def count_untagged():
+    with _db_lock:
+        return get_db_conn().execute(UNTAGGED_COUNT_SQL).fetchone()[0]
+
+def plan_windows(after_id, size, count):
+    # Splits the next count*size untagged ids after after_id into [lo, hi] windows of
+    # up to size photos each; returns the windows and the after_id to plan from next
+    with _db_lock:
+        ids = [row[0] for row in get_db_conn().execute(UNTAGGED_IDS_SQL, (after_id, size * count))]
+    windows = [[ids[i], ids[min(i + size, len(ids)) - 1]] for i in range(0, len(ids), size)]
+    return windows, (ids[-1] if ids else None)
+
+def annotate_window(lo, hi):
+    # Tags the untagged photos with ids in [lo, hi] and returns how many were tagged.
+    # The lock is only held to read the window and to write the tags, so concurrent
+    # batch requests are not serialized on the downloads and geocoding in between.
+    with _db_lock:
+        photos = get_db_conn().execute(UNTAGGED_BATCH_SQL, (lo, hi)).fetchall()
+    tags = []
+    for photo_id, url in photos:
+        try:
+            resp = _http.get(url, timeout=10)
+            if resp.status_code != 200:
+                continue
+            # 1. Try EXIF GPS (parsed in memory, no temp file round-trip)
+            gps = extract_gps_from_exif(resp.content)
+            tag = None
+            if gps:
+                lat, lon = gps
+                tag = reverse_geocode(lat, lon)
+            # 2. If no GPS, try Vision API
+            if not tag:
+                tag = google_vision_landmark(resp.content)
+            # 3. If found, queue the DB update
+            if tag:
+                tags.append((tag, photo_id))
+        except Exception:
+            continue
+    # Batches that tagged nothing skip the write transaction (and keep the folders cache warm)
+    if tags:
+        with db_transaction() as conn:
+            conn.executemany('UPDATE photos SET location_tag=? WHERE id=?', tags)
+    return len(tags)
+
+@app.route('/api/annotate-locations/windows', methods=['GET'])
+def annotate_locations_windows():
+    """
+    Plan the next annotate windows from the untagged photos.
+    Query params:
+      - after_id (default 0): plan from the first untagged id above this one
+      - size (default 10): photos per window
+      - count (default 1, at most ANNOTATE_MAX_BATCHES): number of windows
+    Returns: [lo, hi] windows and the after_id for the next call (null once the pass is done).
+    """
+    after_id = request.args.get('after_id', 0, type=int)
+    size = request.args.get('size', 10, type=int)
+    count = request.args.get('count', 1, type=int)
+    if size < 1 or not 1 <= count <= ANNOTATE_MAX_BATCHES:
+        return jsonify({'error': f'size must be positive and count between 1 and {ANNOTATE_MAX_BATCHES}'}), 400
+    windows, next_after_id = plan_windows(after_id, size, count)
+    return jsonify({'windows': windows, 'after_id': next_after_id})
+
 @app.route('/api/annotate-locations', methods=['POST'])
 def annotate_locations():
-    print(f"[PHOTO-PORTFOLIO] [annotate_locations] Using DB file: {os.path.abspath(DB_PATH)}")
-    logging.info(f"[annotate_locations] Using DB file: {os.path.abspath(DB_PATH)}")
     """
     Batch annotate photos in the DB with location_tag using EXIF GPS (if available),
     else Google Vision landmark detection. Processes only a batch per call.
     Query params:
-      - batch_size (default 10)
-      - offset (default 0)
+      - lo, hi: inclusive photo id window to process (from /api/annotate-locations/windows)
     Returns: progress info and how many annotated in this batch.
     """
-    import tempfile, os, requests
-    batch_size = int(request.args.get('batch_size', 10))
-    offset = int(request.args.get('offset', 0))
-    updated = 0
-    with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        # Count total untagged
-        c.execute('SELECT COUNT(*) FROM photos WHERE location_tag IS NULL OR location_tag = "" OR location_tag = "null"')
-        total_untagged = c.fetchone()[0]
-        # Get batch
-        c.execute('SELECT id, url FROM photos WHERE location_tag IS NULL OR location_tag = "" OR location_tag = "null" LIMIT ? OFFSET ?', (batch_size, offset))
-        photos = c.fetchall()
-        for photo_id, url in photos:
-            try:
-                resp = requests.get(url, timeout=10)
-                if resp.status_code != 200:
-                    continue
-                with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                    tmp.write(resp.content)
-                    tmp_path = tmp.name
-                # 1. Try EXIF GPS
-                gps = extract_gps_from_exif(tmp_path)
-                tag = None
-                if gps:
-                    lat, lon = gps
-                    tag = reverse_geocode(lat, lon)
-                # 2. If no GPS, try Vision API
-                if not tag:
-                    tag = google_vision_landmark(resp.content)
-                # 3. If found, update DB
-                if tag:
-                    c.execute('UPDATE photos SET location_tag=? WHERE id=?', (tag, photo_id))
-                    updated += 1
-                os.remove(tmp_path)
-            except Exception:
-                continue
-        # Count remaining after this batch
-        c.execute('SELECT COUNT(*) FROM photos WHERE location_tag IS NULL OR location_tag = ""')
-        remaining = c.fetchone()[0]
-        conn.commit()
-        conn.close()
+    lo = request.args.get('lo', type=int)
+    hi = request.args.get('hi', type=int)
+    if lo is None or hi is None:
+        return jsonify({'error': 'lo and hi are required integers'}), 400
+    total_untagged = count_untagged()
+    updated = annotate_window(lo, hi)
     return jsonify({
         'status': 'ok',
-        'batch_size': batch_size,
-        'offset': offset,
+        'lo': lo,
+        'hi': hi,
         'updated_this_batch': updated,
-        'remaining_untagged': remaining,
+        'remaining_untagged': count_untagged(),
         'total_untagged': total_untagged
     })
 
+@app.route('/api/annotate-locations/batch', methods=['POST'])
+def annotate_locations_batch():
+    """
+    Run several annotate-locations batches in one request.
+    JSON body: {"batches": [{"lo": 1, "hi": 14}, ...]} (at most ANNOTATE_MAX_BATCHES)
+    Returns: per-batch updates in request order, plus progress counts taken once for the request.
+    """
+    data = request.get_json(silent=True)
+    batches = data.get('batches') if isinstance(data, dict) else None
+    if not isinstance(batches, list) or not batches or len(batches) > ANNOTATE_MAX_BATCHES:
+        return jsonify({'error': f'batches must be a list of 1-{ANNOTATE_MAX_BATCHES} {{lo, hi}} objects'}), 400
+    try:
+        specs = [(int(b['lo']), int(b['hi'])) for b in batches]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'lo and hi are required integers'}), 400
+    total_untagged = count_untagged()
+    results = [{'lo': lo, 'hi': hi, 'updated_this_batch': annotate_window(lo, hi)} for lo, hi in specs]
+    return jsonify({
+        'status': 'ok',
+        'results': results,
+        'remaining_untagged': count_untagged(),
+        'total_untagged': total_untagged
+    })
+
+REINDEX_BATCH_SIZE = 500
+# Single source for supported image types: reindex matches blobs by extension,
+# uploads and signed URLs accept exactly the mimetypes listed here
+_EXT_MIME = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+    'heic': 'image/heic',
+    'heif': 'image/heif',
+}
+_IMAGE_EXTS = frozenset(_EXT_MIME)
+ALLOWED_MIMES = frozenset(_EXT_MIME.values())
+
 @app.route('/api/reindex-gcs', methods=['POST'])
 def reindex_gcs():
-    print(f"[PHOTO-PORTFOLIO] [reindex_gcs] Using DB file: {os.path.abspath(DB_PATH)}")
-    logging.info(f"[reindex_gcs] Using DB file: {os.path.abspath(DB_PATH)}")
     try:
         client = get_gcs_client()
         bucket = client.bucket(GCS_BUCKET)
-        blobs = bucket.list_blobs(prefix='folders/')
+        # Iterate pages lazily and ask GCS only for the fields the loop reads
+        blobs = bucket.list_blobs(prefix='folders/', fields='items(name,contentType),nextPageToken')
         folders = set()
+        photo_rows = []
         file_count = 0
-        for blob in blobs:
-            # Skip the root 'folders/' blob if it exists
-            if blob.name == 'folders/':
-                continue
-            # Parse folder and filename from blob name
-            parts = blob.name.split('/')
-            if len(parts) >= 2:
-                folder = parts[1]
-                if folder:
-                    folders.add(folder)
-                # If this is a file (not a directory marker), add photo
-                if len(parts) >= 3 and not blob.name.endswith('/'):
-                    filename = '/'.join(parts[2:])  # Support nested files
-                    url = f'https://storage.googleapis.com/{bucket.name}/{blob.name}'
-                    mimetype = blob.content_type or 'image/jpeg'
-                    add_folder_to_db(folder)
-                    add_photo_to_db(folder, filename, url, mimetype, blob.name)
-                    file_count += 1
+        pending = None
+        # One DB worker dedups/inserts the previous batch while the next page of blobs is listed
+        with ThreadPoolExecutor(max_workers=1) as db_worker:
+            for blob in blobs:
+                # Skip the root 'folders/' blob if it exists
+                if blob.name == 'folders/':
+                    continue
+                # Parse folder and filename from blob name
+                parts = blob.name.split('/')
+                if len(parts) >= 2:
+                    folder = parts[1]
+                    if folder:
+                        folders.add(folder)
+                    # If this is an image file (not a directory marker), add photo
+                    ext = blob.name.rpartition('.')[2].lower()
+                    if len(parts) >= 3 and ext in _IMAGE_EXTS:
+                        filename = '/'.join(parts[2:])  # Support nested files
+                        url = gcs_public_url(blob.name)
+                        mimetype = blob.content_type or _EXT_MIME[ext]
+                        photo_rows.append((folder, filename, url, mimetype, blob.name, None))
+                        # Commit in fixed-size batches so memory stays bounded on large buckets
+                        if len(photo_rows) >= REINDEX_BATCH_SIZE:
+                            if pending:
+                                file_count += pending.result()
+                            pending = db_worker.submit(add_new_photos_to_db, photo_rows)
+                            photo_rows = []
+            if pending:
+                file_count += pending.result()
+        if photo_rows:
+            file_count += add_new_photos_to_db(photo_rows)
         # Add all folders found, even if empty
         for folder in folders:
             add_folder_to_db(folder)
         return jsonify({'status': 'ok', 'folders': list(folders), 'indexed_files': file_count}), 200
     except Exception as e:
-        import traceback
         return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
 
 # Set your GCS bucket name
 GCS_BUCKET = 'photoportfolio-uploads'
+# The bucket uses uniform bucket-level access with public read, so object URLs
+# are templated locally instead of making a per-object ACL call
+GCS_PUBLIC_URL_BASE = f'https://storage.googleapis.com/{GCS_BUCKET}/'
+
+def gcs_public_url(gcs_path):
+    return GCS_PUBLIC_URL_BASE + quote(gcs_path)
 
 # SQLite setup
 _db_lock = threading.Lock()
+_db_conn = None
+# Folder names already known to exist in the DB, so repeat uploads skip the INSERT
+_known_folders = set()
+# Serialized GET /api/folders body; db_transaction() bumps the generation on every committed write
+FOLDERS_CACHE_TTL = 30  # seconds
+_folders_cache = {'gen': -1, 'ts': 0.0, 'body': None, 'etag': None}
+_folders_cache_gen = 0
+
+# Kept as module constants so sqlite3's per-connection statement cache is hit
+PHOTO_INSERT_SQL = 'INSERT INTO photos (folder, name, url, mimetype, gcs_path, location_tag, text) VALUES (?, ?, ?, ?, ?, ?, ?)'
+FOLDER_INSERT_SQL = 'INSERT OR IGNORE INTO folders (name) VALUES (?)'
+SQLITE_MAX_PARAMS = 900
+
+def get_db_conn():
+    # Shared connection for all reads and writes; callers must hold _db_lock
+    global _db_conn
+    if _db_conn is None:
+        _db_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _db_conn.execute('PRAGMA cache_size=-20000')
+        _db_conn.execute('PRAGMA temp_store=MEMORY')
+    return _db_conn
+
+@atexit.register
+def _close_db_conn():
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+@contextmanager
+def db_transaction():
+    # Serializes on _db_lock; commits on success and rolls back on error so the
+    # shared connection is never left mid-transaction
+    global _folders_cache_gen
+    with _db_lock:
+        conn = get_db_conn()
+        changes = conn.total_changes
+        with conn:
+            yield conn
+        # Only a committed write can change the folder listing; rolled-back or
+        # read-only blocks leave the folders cache valid
+        if conn.total_changes != changes:
+            _folders_cache_gen += 1
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    mimetype TEXT,
+    gcs_path TEXT,
+    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_photos_gcs_path ON photos (gcs_path);
+CREATE INDEX IF NOT EXISTS idx_photos_folder_uploaded ON photos (folder, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS idx_photos_uploaded_id ON photos (uploaded_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+# Bump when SCHEMA_SQL or the migrations below change
+SCHEMA_VERSION = 6
 
 def init_db():
-    print(f"[PHOTO-PORTFOLIO] [init_db] Using DB file: {os.path.abspath(DB_PATH)}")
-    logging.info(f"[init_db] Using DB file: {os.path.abspath(DB_PATH)}")
     with _db_lock:
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS folders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS photos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            folder TEXT NOT NULL,
-            name TEXT NOT NULL,
-            url TEXT NOT NULL,
-            mimetype TEXT,
-            gcs_path TEXT,
-            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
+        # Skip DDL and table_info introspection on files already at this version
+        c.execute('PRAGMA user_version')
+        if c.fetchone()[0] >= SCHEMA_VERSION:
+            conn.close()
+            return
+        c.executescript(SCHEMA_SQL)
         # Migration: add location_tag if not exists
         c.execute("PRAGMA table_info(photos)")
         columns = [row[1] for row in c.fetchall()]
         if 'location_tag' not in columns:
             c.execute('ALTER TABLE photos ADD COLUMN location_tag TEXT')
+        # Partial index over the untagged photos for annotate window planning and counts
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_photos_untagged ON photos (id) WHERE {_UNTAGGED_WHERE}')
+        # Migration: denormalized embedding input for semantic search
+        if 'text' not in columns:
+            c.execute('ALTER TABLE photos ADD COLUMN text TEXT')
+            c.execute("UPDATE photos SET text = name || ' ' || folder || ' ' || IFNULL(mimetype, 'None')")
+        # Random identity minted once per DB file, so derived files (the ANN index) can tell DBs apart
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('db_id', ?)", (secrets.token_hex(8),))
+        c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
         conn.close()
 
-init_db()
+if os.environ.get('SKIP_SCHEMA_BOOTSTRAP') != '1':
+    init_db()
+
+# Open the shared connection at startup so the first request doesn't pay for it
+with _db_lock:
+    get_db_conn()
 
+def get_db_id():
+    with _db_lock:
+        try:
+            row = get_db_conn().execute("SELECT value FROM meta WHERE key = 'db_id'").fetchone()
+        except sqlite3.OperationalError:
+            # Schema bootstrap was skipped on a DB without the meta table
+            return None
+    return row[0] if row else None
+
+@lru_cache(maxsize=1)
 def get_gcs_client():
+    # storage.Client() resolves credentials and opens an HTTP session; build it once per process
     return storage.Client()
 
+BUCKET_CHECK_TTL = 30  # seconds
+_bucket_checked_at = None
+# Files above this go through a resumable upload in chunks of this size (a 256 KiB multiple)
+GCS_CHUNK_SIZE = 8 * 1024 * 1024
+
 def ensure_bucket_exists():
+    global _bucket_checked_at
     client = get_gcs_client()
     bucket = client.bucket(GCS_BUCKET)
+    # bucket.exists() is a GCS round-trip; re-probe at most once per TTL instead of per file
+    if _bucket_checked_at is not None and time.monotonic() - _bucket_checked_at < BUCKET_CHECK_TTL:
+        return bucket
     if not bucket.exists():
         bucket = client.create_bucket(GCS_BUCKET, location="us")
         bucket.iam_configuration.uniform_bucket_level_access_enabled = True
         bucket.patch()
         # Make bucket public
         bucket.make_public(future=True)
+    _bucket_checked_at = time.monotonic()
     return bucket
 
 def upload_to_gcs(file, folder):
     client = get_gcs_client()
     bucket = ensure_bucket_exists()
-    filename = secure_filename(file.filename)
-    unique_name = f"{uuid.uuid4().hex[:8]}_{filename}"
+    filename = _safe(file.filename)
+    unique_name = f"{secrets.token_urlsafe(6)}_{filename}"
     blob_path = f"folders/{folder}/{unique_name}"
-    blob = bucket.blob(blob_path)
-    blob.upload_from_file(file, content_type=file.mimetype)
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    blob = bucket.blob(blob_path, chunk_size=GCS_CHUNK_SIZE if size > GCS_CHUNK_SIZE else None)
+    blob.upload_from_file(file, content_type=file.mimetype, size=size)
     # Do not call blob.make_public(); rely on bucket-level IAM for public access
     return {
         'name': filename,
-        'url': f'https://storage.googleapis.com/{bucket.name}/{blob_path}',
+        'url': gcs_public_url(blob_path),
         'mimetype': file.mimetype,
         'gcs_path': blob_path
     }
 
 def add_folder_to_db(folder):
-    print(f"[PHOTO-PORTFOLIO] [add_folder_to_db] Using DB file: {os.path.abspath(DB_PATH)}")
-    logging.info(f"[add_folder_to_db] Using DB file: {os.path.abspath(DB_PATH)}")
-    with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('INSERT OR IGNORE INTO folders (name) VALUES (?)', (folder,))
-        conn.commit()
-        conn.close()
+    if folder in _known_folders:
+        return
+    with db_transaction() as conn:
+        conn.execute(FOLDER_INSERT_SQL, (folder,))
+        _known_folders.add(folder)
+
+def add_photos_to_db(rows):
+    # rows: iterable of (folder, name, url, mimetype, gcs_path, location_tag)
+    params = [row + (f"{row[1]} {row[0]} {row[3]}",) for row in rows]
+    with db_transaction() as conn:
+        conn.executemany(PHOTO_INSERT_SQL, params)
 
-def add_photo_to_db(folder, name, url, mimetype, gcs_path, location_tag=None):
-    print(f"[PHOTO-PORTFOLIO] [add_photo_to_db] Using DB file: {os.path.abspath(DB_PATH)}")
-    logging.info(f"[add_photo_to_db] Using DB file: {os.path.abspath(DB_PATH)}")
+def get_existing_gcs_paths(gcs_paths):
+    # Chunked IN lookups stay under SQLite's bound-parameter limit
+    existing = set()
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        # Insert with location_tag if provided
-        if location_tag is not None:
-            c.execute('''INSERT INTO photos (folder, name, url, mimetype, gcs_path, location_tag) VALUES (?, ?, ?, ?, ?, ?)''',
-                      (folder, name, url, mimetype, gcs_path, location_tag))
-        else:
-            c.execute('''INSERT INTO photos (folder, name, url, mimetype, gcs_path) VALUES (?, ?, ?, ?, ?)''',
-                      (folder, name, url, mimetype, gcs_path))
-        conn.commit()
-        conn.close()
+        conn = get_db_conn()
+        for i in range(0, len(gcs_paths), SQLITE_MAX_PARAMS):
+            chunk = gcs_paths[i:i + SQLITE_MAX_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            existing.update(row[0] for row in conn.execute(f'SELECT gcs_path FROM photos WHERE gcs_path IN ({placeholders})', chunk))
+    return existing
+
+def add_new_photos_to_db(rows):
+    # Skip rows whose gcs_path is already indexed; returns the number inserted
+    existing = get_existing_gcs_paths([row[4] for row in rows])
+    new_rows = [row for row in rows if row[4] not in existing]
+    if new_rows:
+        add_photos_to_db(new_rows)
+    return len(new_rows)
 
 def get_all_folders():
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db_conn()
         c = conn.cursor()
         c.execute('SELECT name FROM folders')
         folders = [row[0] for row in c.fetchall()]
-        conn.close()
         return folders
 
 def get_photos_by_folder():
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT folder, name, url, mimetype, location_tag FROM photos')
-        photos = c.fetchall()
-        conn.close()
+        conn = get_db_conn()
         folder_dict = {}
-        for folder, name, url, mimetype, location_tag in photos:
+        # Group straight off the cursor rather than materializing every row first
+        for folder, name, url, mimetype, location_tag in conn.execute('SELECT folder, name, url, mimetype, location_tag FROM photos'):
             folder_dict.setdefault(folder, []).append({
                 'name': name,
                 'url': url,
@@ -323,45 +555,59 @@ def get_photos_by_folder():
             })
         return folder_dict
 
+def get_folders_json():
+    # Returns (body, etag); the ETag is a content hash so unchanged listings revalidate as 304
+    cache = _folders_cache
+    gen = _folders_cache_gen
+    if cache['gen'] == gen and time.monotonic() - cache['ts'] < FOLDERS_CACHE_TTL:
+        return cache['body'], cache['etag']
+    body = orjson.dumps(get_photos_by_folder(), option=orjson.OPT_SORT_KEYS)
+    etag = hashlib.sha256(body).hexdigest()[:16]
+    # Only publish if no write landed while we were reading
+    if gen == _folders_cache_gen:
+        cache.update(gen=gen, ts=time.monotonic(), body=body, etag=etag)
+    return body, etag
+
+# The GCS JSON API accepts at most 100 calls per batch request
+GCS_BATCH_SIZE = 100
+
+def delete_gcs_blobs(gcs_paths):
+    paths = [p for p in gcs_paths if p]
+    if not paths:
+        return
+    client = get_gcs_client()
+    bucket = client.bucket(GCS_BUCKET)
+    for i in range(0, len(paths), GCS_BATCH_SIZE):
+        # Inside client.batch() the deletes are deferred and sent as one multipart request
+        try:
+            with client.batch():
+                for path in paths[i:i + GCS_BATCH_SIZE]:
+                    bucket.delete_blob(path)
+        except NotFound:
+            # A blob that is already gone is the state we want; every call in the
+            # batch has still been executed
+            pass
+
 def delete_photo_from_db(folder, name):
-    with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT gcs_path FROM photos WHERE folder=? AND name=?', (folder, name))
-        row = c.fetchone()
-        if row:
-            gcs_path = row[0]
-            c.execute('DELETE FROM photos WHERE folder=? AND name=?', (folder, name))
-            conn.commit()
-            conn.close()
-            # Delete from GCS
-            client = get_gcs_client()
-            bucket = client.bucket(GCS_BUCKET)
-            blob = bucket.blob(gcs_path)
-            blob.delete()
-            return True
-        conn.close()
-        return False
+    with db_transaction() as conn:
+        # DELETE ... RETURNING removes the rows and yields their blob paths in one statement
+        rows = conn.execute('DELETE FROM photos WHERE folder=? AND name=? RETURNING id, gcs_path', (folder, name)).fetchall()
+    # Drop the vectors first so semantic search stops returning the rows even if GCS fails;
+    # blobs are deleted after the commit so _db_lock isn't held across GCS round-trips
+    remove_from_ann_index([photo_id for photo_id, _ in rows])
+    delete_gcs_blobs(gcs_path for _, gcs_path in rows)
+    return bool(rows)
 
 def delete_folder_from_db(folder):
-    with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT gcs_path FROM photos WHERE folder=?', (folder,))
-        rows = c.fetchall()
-        c.execute('DELETE FROM photos WHERE folder=?', (folder,))
-        c.execute('DELETE FROM folders WHERE name=?', (folder,))
-        conn.commit()
-        conn.close()
-        # Delete all blobs in GCS for this folder
-        client = get_gcs_client()
-        bucket = client.bucket(GCS_BUCKET)
-        for (gcs_path,) in rows:
-            blob = bucket.blob(gcs_path)
-            blob.delete()
-        return True
-
-from flask import make_response
+    with db_transaction() as conn:
+        rows = conn.execute('DELETE FROM photos WHERE folder=? RETURNING id, gcs_path', (folder,)).fetchall()
+        folder_rows = conn.execute('DELETE FROM folders WHERE name=?', (folder,)).rowcount
+        _known_folders.discard(folder)
+    remove_from_ann_index([photo_id for photo_id, _ in rows])
+    # Delete all blobs in GCS for this folder, outside the DB lock
+    delete_gcs_blobs(gcs_path for _, gcs_path in rows)
+    # The DELETEs already report what existed; no separate COUNT/EXISTS query needed
+    return bool(rows) or folder_rows > 0
 
 @app.errorhandler(413)
 def handle_413(e):
@@ -371,9 +617,10 @@ def handle_413(e):
     response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
     return response
 
+UPLOAD_WORKERS = 8
+
 @app.route('/api/upload', methods=['POST'])
 def upload_photos():
-    import traceback
     folder = request.form.get('folder')
     files = request.files.getlist('images')
     if not folder or not files:
@@ -382,19 +629,30 @@ def upload_photos():
         resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         return resp
-    folder = secure_filename(folder)
+    # Drop non-image payloads before paying for any GCS upload
+    rejected = [file.filename for file in files if file.mimetype not in ALLOWED_MIMES]
+    files = [file for file in files if file.mimetype in ALLOWED_MIMES]
+    if not files:
+        return jsonify({'error': 'Unsupported file type.', 'rejected': rejected}), 415
+    folder = _safe(folder)
     add_folder_to_db(folder)
     uploaded = []
-    for file in files:
+    photo_rows = []
+    # GCS uploads are network-bound, so overlap them; results are consumed in request order
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(files))) as pool:
+        futures = [pool.submit(upload_to_gcs, file, folder) for file in files]
+    for future in futures:
         try:
-            file.stream.seek(0)
-            photo_info = upload_to_gcs(file, folder)
-            add_photo_to_db(folder, photo_info['name'], photo_info['url'], photo_info['mimetype'], photo_info['gcs_path'])
+            photo_info = future.result()
+            photo_rows.append((folder, photo_info['name'], photo_info['url'], photo_info['mimetype'], photo_info['gcs_path'], None))
             uploaded.append({'name': photo_info['name'], 'url': photo_info['url'], 'mimetype': photo_info['mimetype']})
         except Exception as e:
             print(f"[UPLOAD ERROR] {e}\n{traceback.format_exc()}")
             # Continue uploading other files, but log error
-    resp = make_response(jsonify({'folder': folder, 'uploaded': uploaded, 'folders': get_all_folders()}), 201)
+    # One executemany for the whole batch instead of a transaction per file
+    if photo_rows:
+        add_photos_to_db(photo_rows)
+    resp = make_response(jsonify({'folder': folder, 'uploaded': uploaded, 'rejected': rejected, 'folders': get_all_folders()}), 201)
     resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
     resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
     resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
@@ -410,7 +668,10 @@ def get_folders():
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         return resp
     try:
-        resp = make_response(jsonify(get_photos_by_folder()))
+        body, etag = get_folders_json()
+        resp = app.response_class(body, mimetype='application/json')
+        resp.set_etag(etag)
+        resp.make_conditional(request)
         resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
         resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
@@ -422,6 +683,19 @@ def get_folders():
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         return resp
 
+# Column order of the search SELECT; rows are zipped into dicts in C
+_SEARCH_KEYS = ('folder', 'name', 'url', 'mimetype', 'uploaded_at')
+
+def _encode_cursor(uploaded_at, photo_id):
+    return base64.urlsafe_b64encode(orjson.dumps([uploaded_at, photo_id])).decode()
+
+def _decode_cursor(cursor):
+    uploaded_at, photo_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+    # A non-string timestamp would compare by SQLite type order instead of by time
+    if not isinstance(uploaded_at, str):
+        raise ValueError('cursor timestamp must be a string')
+    return uploaded_at, int(photo_id)
+
 @app.route('/api/photos/search', methods=['GET'])
 def search_photos():
     name = request.args.get('name', '').strip()
@@ -429,7 +703,14 @@ def search_photos():
     mimetype = request.args.get('mimetype', '').strip()
     date_from = request.args.get('date_from', '').strip()
     date_to = request.args.get('date_to', '').strip()
-    query = "SELECT folder, name, url, mimetype, uploaded_at FROM photos WHERE 1=1"
+    limit = request.args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return jsonify({'error': 'limit must be a positive integer'}), 400
+        limit = int(limit)
+    after = request.args.get('after', '').strip()
+    # id is selected last for the page cursor; zip() with _SEARCH_KEYS leaves it out of the results
+    query = "SELECT folder, name, url, mimetype, uploaded_at, id FROM photos WHERE 1=1"
     params = []
     if name:
         query += " AND name LIKE ?"
@@ -446,17 +727,34 @@ def search_photos():
     if date_to:
         query += " AND uploaded_at <= ?"
         params.append(date_to)
+    paginated = limit is not None or after
+    if paginated:
+        # Keyset pagination: seek past the last row of the previous page on
+        # idx_photos_uploaded_id instead of scanning and discarding an OFFSET
+        if after:
+            try:
+                cursor_ts, cursor_id = _decode_cursor(after)
+            except (ValueError, TypeError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+            query += " AND (uploaded_at, id) < (?, ?)"
+            params += [cursor_ts, cursor_id]
+        limit = min(limit or 100, 500)
+        # Fetch one extra row to learn whether a next page exists without a COUNT(*)
+        query += " ORDER BY uploaded_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db_conn()
         c = conn.cursor()
         c.execute(query, params)
         rows = c.fetchall()
-        conn.close()
-    results = [
-        {'folder': f, 'name': n, 'url': u, 'mimetype': m, 'uploaded_at': d}
-        for f, n, u, m, d in rows
-    ]
-    return jsonify(results)
+    has_next = paginated and len(rows) > limit
+    if has_next:
+        rows = rows[:limit]
+    results = [dict(zip(_SEARCH_KEYS, row)) for row in rows]
+    resp = jsonify(results)
+    if has_next:
+        resp.headers['X-Next-Cursor'] = _encode_cursor(rows[-1][4], rows[-1][5])
+    return resp
 
 @app.route('/api/folders/search', methods=['GET'])
 def search_folders():
@@ -467,17 +765,16 @@ def search_folders():
         query += " AND name LIKE ?"
         params.append(f"%{name}%")
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db_conn()
         c = conn.cursor()
         c.execute(query, params)
         rows = c.fetchall()
-        conn.close()
     results = [row[0] for row in rows]
     return jsonify(results)
 
 @app.route('/api/folder/<folder>', methods=['DELETE'])
 def delete_folder(folder):
-    folder = secure_filename(folder)
+    folder = _safe(folder)
     success = delete_folder_from_db(folder)
     if success:
         return jsonify({'message': f'Folder {folder} deleted.'}), 200
@@ -486,8 +783,8 @@ def delete_folder(folder):
 
 @app.route('/api/folder/<folder>/<name>', methods=['DELETE'])
 def delete_photo(folder, name):
-    folder = secure_filename(folder)
-    name = secure_filename(name)
+    folder = _safe(folder)
+    name = _safe(name)
     success = delete_photo_from_db(folder, name)
     if success:
         return jsonify({'message': f'Photo {name} deleted from folder {folder}.'}), 200
@@ -495,26 +792,25 @@ def delete_photo(folder, name):
         return jsonify({'error': 'Photo not found'}), 404
 
 # --- Direct-to-GCS Upload Endpoints ---
-from flask import make_response
-
 @app.route('/api/signed-url', methods=['POST', 'OPTIONS'])
 def get_signed_url():
     if request.method == 'OPTIONS':
         # CORS preflight request
         return '', 200
-    import traceback
     try:
         data = request.get_json()
         filename = data.get('filename')
         content_type = data.get('contentType')
-        folder = secure_filename(data.get('folder', 'uploads'))
+        folder = _safe(data.get('folder', 'uploads'))
         if not filename or not content_type or not folder:
             resp = make_response(jsonify({'error': 'filename, contentType, and folder are required'}), 400)
             resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
             resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
             resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
             return resp
-        unique_name = f"{uuid.uuid4().hex}_{secure_filename(filename)}"
+        if content_type not in ALLOWED_MIMES:
+            return jsonify({'error': f'Unsupported contentType: {content_type}'}), 415
+        unique_name = f"{secrets.token_urlsafe(16)}_{_safe(filename)}"
         gcs_path = f"folders/{folder}/{unique_name}"
         client = get_gcs_client()
         bucket = client.bucket(GCS_BUCKET)
@@ -525,7 +821,7 @@ def get_signed_url():
             method="PUT",
             content_type=content_type,
         )
-        public_url = f"https://storage.googleapis.com/{GCS_BUCKET}/{gcs_path}"
+        public_url = gcs_public_url(gcs_path)
         resp = make_response(jsonify({'url': url, 'publicUrl': public_url, 'gcsPath': gcs_path}), 200)
         resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
         resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
@@ -540,70 +836,189 @@ def get_signed_url():
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         return resp
 
+def register_uploads_to_db(folder, files):
+    # files: list of {filename, contentType, publicUrl, gcsPath?} dicts, inserted in one executemany
+    add_folder_to_db(folder)
+    add_photos_to_db([
+        (folder, f['filename'], f['publicUrl'], f['contentType'], f.get('gcsPath') or '', None)
+        for f in files
+    ])
+
 @app.route('/api/register-upload', methods=['POST'])
 def register_upload():
     data = request.get_json()
     filename = data.get('filename')
     content_type = data.get('contentType')
-    folder = secure_filename(data.get('folder', 'uploads'))
+    folder = _safe(data.get('folder', 'uploads'))
     public_url = data.get('publicUrl')
-    gcs_path = data.get('gcsPath')
     if not filename or not content_type or not folder or not public_url:
-        resp = make_response(jsonify({'error': 'filename, contentType, folder, and publicUrl are required'}), 400)
-        resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
-        resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
-        resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-        return resp
-    add_folder_to_db(folder)
-    add_photo_to_db(folder, filename, public_url, content_type, gcs_path or '')
-    resp = make_response(jsonify({'ok': True}), 200)
-    resp.headers['Access-Control-Allow-Origin'] = get_cors_origin()
-    resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
-    resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-    return resp
+        return jsonify({'error': 'filename, contentType, folder, and publicUrl are required'}), 400
+    register_uploads_to_db(folder, [data])
+    return jsonify({'ok': True}), 200
+
+@app.route('/api/register-uploads', methods=['POST'])
+def register_uploads():
+    """
+    Register a batch of direct-to-GCS uploads in a single transaction.
+    Body: {"folder": ..., "files": [{"filename", "contentType", "publicUrl", "gcsPath"}, ...]}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'JSON object body required'}), 400
+    folder = data.get('folder', 'uploads')
+    if not isinstance(folder, str):
+        return jsonify({'error': 'folder must be a string'}), 400
+    folder = _safe(folder)
+    files = data.get('files')
+    if not isinstance(files, list) or not files or not all(
+        isinstance(f, dict)
+        and all(isinstance(f.get(key), str) and f[key] for key in ('filename', 'contentType', 'publicUrl'))
+        and isinstance(f.get('gcsPath') or '', str)
+        for f in files
+    ):
+        return jsonify({'error': 'files with string filename, contentType, and publicUrl (and optional gcsPath) are required'}), 400
+    register_uploads_to_db(folder, files)
+    return jsonify({'ok': True, 'registered': len(files)}), 200
 
-import os
 # --- AI-powered Semantic Search Endpoint ---
 # Model is loaded at module level to avoid reloading on every request
 _semantic_model = SentenceTransformer('all-MiniLM-L6-v2')
 
+# HNSW index over photo embeddings, keyed by photo id
+ANN_INDEX_PATH = os.environ.get('ANN_INDEX_PATH', 'photos.usearch')
+# Sidecar recording which DB the saved index was built from
+ANN_META_PATH = ANN_INDEX_PATH + '.meta.json'
+def _new_ann_index():
+    return Index(ndim=384, metric='cos', dtype='f16')
+
+_ann = _new_ann_index()
+_ann_lock = threading.Lock()
+# Held for the duration of a full rebuild so two rebuilds never run at once
+_ann_rebuild_lock = threading.Lock()
+# Shared secret for maintenance routes; they are disabled when unset
+MAINTENANCE_TOKEN = os.environ.get('MAINTENANCE_TOKEN')
+_ann_max_id = 0
+_ann_db_id = get_db_id()
+EMBED_BATCH_SIZE = 64
+
+def _ann_index_matches_db():
+    try:
+        with open(ANN_META_PATH, 'rb') as f:
+            meta = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return False
+    return _ann_db_id is not None and meta.get('db_id') == _ann_db_id
+
+# An index saved against another (or a reset) DB would skip new ids below its
+# high-water mark and map stale keys to unrelated rows, so it is rebuilt instead
+if os.path.exists(ANN_INDEX_PATH) and _ann_index_matches_db():
+    _ann.load(ANN_INDEX_PATH)
+    if len(_ann):
+        _ann_max_id = int(max(_ann.keys))
+
+@atexit.register
+def _save_ann_index():
+    with _ann_lock:
+        _ann.save(ANN_INDEX_PATH)
+        with open(ANN_META_PATH, 'wb') as f:
+            f.write(orjson.dumps({'db_id': _ann_db_id}))
+
+def remove_from_ann_index(photo_ids):
+    # Deleted photos must leave the index, or they crowd live photos out of the top-k
+    if photo_ids:
+        with _ann_lock:
+            _ann.remove(np.array(photo_ids, dtype=np.uint64))
+
+def _fetch_unindexed_rows(after_id):
+    with _db_lock:
+        conn = get_db_conn()
+        c = conn.cursor()
+        c.execute('SELECT id, text FROM photos WHERE id > ? ORDER BY id', (after_id,))
+        return c.fetchall()
+
+def _embed_rows(index, rows):
+    # Adds (id, text) rows to index and returns the highest id added
+    keys = np.array([row[0] for row in rows], dtype=np.uint64)
+    index.add(keys, _semantic_model.encode([row[1] for row in rows], batch_size=EMBED_BATCH_SIZE))
+    return int(keys[-1])
+
+def sync_ann_index():
+    # Embed photos added since the last sync; caller must hold _ann_lock
+    global _ann_max_id
+    rows = _fetch_unindexed_rows(_ann_max_id)
+    if rows:
+        _ann_max_id = _embed_rows(_ann, rows)
+
+def _maintenance_authorized():
+    if not MAINTENANCE_TOKEN:
+        return False
+    auth = request.headers.get('Authorization', '')
+    return secrets.compare_digest(auth.encode(), f'Bearer {MAINTENANCE_TOKEN}'.encode())
+
+@app.route('/api/reindex-embeddings', methods=['POST'])
+def reindex_embeddings():
+    """
+    Rebuild the semantic search index from the stored photos.text column.
+    Requires the header "Authorization: Bearer <MAINTENANCE_TOKEN>".
+    """
+    global _ann, _ann_max_id
+    if not _maintenance_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not _ann_rebuild_lock.acquire(blocking=False):
+        return jsonify({'error': 'Reindex already running'}), 409
+    try:
+        # Encode into a fresh index without _ann_lock so searches keep using the old one
+        index = _new_ann_index()
+        rows = _fetch_unindexed_rows(0)
+        max_id = _embed_rows(index, rows) if rows else 0
+        with _ann_lock:
+            # Deletes that landed during the rebuild only reached the old index
+            with _db_lock:
+                live = {row[0] for row in get_db_conn().execute('SELECT id FROM photos WHERE id <= ?', (max_id,))}
+            gone = [photo_id for photo_id, _ in rows if photo_id not in live]
+            if gone:
+                index.remove(np.array(gone, dtype=np.uint64))
+            _ann, _ann_max_id = index, max_id
+            indexed = len(index)
+    finally:
+        _ann_rebuild_lock.release()
+    return jsonify({'status': 'ok', 'indexed_photos': indexed}), 200
+
 @app.route('/api/photos/semantic-search', methods=['GET'])
 def semantic_search_photos():
     query = request.args.get('q', '').strip()
     if not query:
         return jsonify({'error': 'Missing query'}), 400
-    # Fetch all photo metadata from DB
+    query_embedding = _semantic_model.encode([query])[0]
+    with _ann_lock:
+        sync_ann_index()
+        if len(_ann) == 0:
+            return jsonify([])
+        matches = _ann.search(query_embedding, 10)  # Top 10
+    # Cosine distance -> similarity; a photo deleted mid-search drops out below
+    scores = {int(key): 1.0 - float(dist) for key, dist in zip(matches.keys, matches.distances)}
+    if not scores:
+        return jsonify([])
+    placeholders = ','.join('?' * len(scores))
     with _db_lock:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db_conn()
         c = conn.cursor()
-        c.execute('SELECT folder, name, url, mimetype, uploaded_at FROM photos')
+        c.execute(f'SELECT id, folder, name, url, mimetype, uploaded_at FROM photos WHERE id IN ({placeholders})', list(scores))
         rows = c.fetchall()
-        conn.close()
-    if not rows:
-        return jsonify([])
-    # Prepare texts for embedding
-    photo_texts = [f"{name} {folder} {mimetype}" for folder, name, url, mimetype, uploaded_at in rows]
-    photo_embeddings = _semantic_model.encode(photo_texts)
-    query_embedding = _semantic_model.encode([query])[0]
-    # Compute cosine similarity
-    similarities = np.dot(photo_embeddings, query_embedding) / (
-        np.linalg.norm(photo_embeddings, axis=1) * np.linalg.norm(query_embedding) + 1e-8
-    )
-    top_indices = np.argsort(similarities)[::-1][:10]  # Top 10
     results = [
         {
-            'folder': rows[i][0],
-            'name': rows[i][1],
-            'url': rows[i][2],
-            'mimetype': rows[i][3],
-            'uploaded_at': rows[i][4],
-            'score': float(similarities[i])
+            'folder': folder,
+            'name': name,
+            'url': url,
+            'mimetype': mimetype,
+            'uploaded_at': uploaded_at,
+            'score': scores[photo_id]
         }
-        for i in top_indices
+        for photo_id, folder, name, url, mimetype, uploaded_at in rows
     ]
+    results.sort(key=lambda r: r['score'], reverse=True)
     return jsonify(results)
 
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
@@ -1,32 +1,149 @@
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-def annotate_all_batches(api_url, batch_size=10, interval_sec=60):
-    offset = 0
-    total = None
-    while True:
-        resp = requests.post(f"{api_url}?batch_size={batch_size}&offset={offset}")
-        if resp.status_code != 200:
-            print(f"Error: {resp.status_code}: {resp.text}")
-            break
-        data = resp.json()
-        print(f"Batch offset {offset}: updated {data.get('updated_this_batch', 0)}, remaining: {data.get('remaining_untagged', '?')}")
-        if total is None:
-            total = data.get('total_untagged', 0)
-        remaining = data.get('remaining_untagged', 0)
-        if remaining == 0:
-            print("All images have been annotated.")
-            break
-        offset += batch_size
-        # If we hit the end, reset offset to 0 to catch any new images
-        if offset >= total:
-            offset = 0
-            total = remaining
-        time.sleep(interval_sec)
+from http_session import pooled_session
+
+# Shared session so every batch reuses pooled TCP/TLS connections to the backend;
+# the pool is sized above the dispatch concurrency. Adapter retries are off:
+# _with_backoff is the only retry layer.
+_http = pooled_session(retries=0)
+# Matches Cloud Run's default request timeout; a batch still running past it is lost anyway
+REQUEST_TIMEOUT = 300  # seconds
+
+# Statuses that mean "back off and retry the same request" rather than abort
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# A retryable status that keeps coming back is treated as a server bug, not load
+MAX_CONSECUTIVE_ERRORS = 8
+
+def backoff_delay(resp, consecutive_errors, base=1.0, max_delay=60):
+    # Prefer the server's Retry-After (seconds form); otherwise grow by 1.3x per
+    # consecutive failure, with up to 10% jitter so parallel callers don't sync up
+    try:
+        delay = float(getattr(resp, 'headers', {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        delay = min(max_delay, base * 1.3 ** consecutive_errors)
+    return delay + random.uniform(0, 0.1 * delay)
+
+def _post(url, **kwargs):
+    # A timeout or dropped connection is returned, not raised, so the backoff loop
+    # treats it like a retryable status
+    try:
+        return _http.post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        return e
+
+def _is_retryable(resp):
+    return isinstance(resp, requests.RequestException) or resp.status_code in RETRY_STATUSES
+
+def _describe(resp):
+    if isinstance(resp, requests.RequestException):
+        return f"{type(resp).__name__}: {resp}"
+    return f"{resp.status_code}: {resp.text}"
+
+def _with_backoff(send):
+    # The only retry layer: calls send() until no response is retryable, sleeping a growing
+    # delay between attempts. Returns the responses (which may hold other errors for the
+    # caller), or None once MAX_CONSECUTIVE_ERRORS retries are used up.
+    for attempt in range(MAX_CONSECUTIVE_ERRORS + 1):
+        responses = send()
+        retryable = [resp for resp in responses if _is_retryable(resp)]
+        if not retryable:
+            return responses
+        if attempt == MAX_CONSECUTIVE_ERRORS:
+            print(f"Error after {MAX_CONSECUTIVE_ERRORS} retries: {_describe(retryable[0])}")
+            return None
+        delay = backoff_delay(retryable[0], attempt + 1)
+        print(f"Request failed ({_describe(retryable[0])}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+def plan_windows(api_url, batch_size, after_id, count):
+    # The server splits the next untagged ids into [lo, hi] windows and returns the next after_id
+    try:
+        return _http.get(f"{api_url}/windows", params={'after_id': after_id, 'size': batch_size, 'count': count}, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        return e
+
+def annotate_batch(api_url, lo, hi):
+    return _post(api_url, params={'lo': lo, 'hi': hi})
+
+def annotate_batches(api_url, windows):
+    # One POST to the /batch route covers several id windows; it returns one result per window
+    return _post(f"{api_url}/batch", json={'batches': [{'lo': lo, 'hi': hi} for lo, hi in windows]})
+
+def annotate_all_batches(api_url, batch_size=10, interval_sec=1, concurrency=4, batches_per_request=5):
+    after_id = 0
+    pass_updated = 0
+    use_batch_route = True
+    # Each round plans `concurrency * batches_per_request` windows over the untagged photos
+    # only and dispatches `concurrency` requests at once; with the /batch route each request
+    # carries `batches_per_request` windows. Windows are disjoint [lo, hi] id ranges, so
+    # parallel batches never overlap, and already-tagged id ranges are never walked.
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            group_size = batches_per_request if use_batch_route else 1
+            plan = _with_backoff(lambda: [plan_windows(api_url, batch_size, after_id, concurrency * group_size)])
+            if plan is None:
+                return
+            if plan[0].status_code != 200:
+                print(f"Error: {_describe(plan[0])}")
+                return
+            plan = plan[0].json()
+            if not plan['windows']:
+                # End of a pass. If nothing was tagged, the rest have no GPS and no landmark,
+                # and another pass would only repeat the same downloads and Vision calls
+                if pass_updated == 0:
+                    print("No more images could be annotated; stopping.")
+                    break
+                # Start over from the lowest untagged id to catch new or skipped images
+                after_id = 0
+                pass_updated = 0
+                continue
+            windows = plan['windows']
+            groups = [windows[i:i + group_size] for i in range(0, len(windows), group_size)]
+            if use_batch_route:
+                responses = _with_backoff(lambda: list(pool.map(lambda g: annotate_batches(api_url, g), groups)))
+            else:
+                responses = _with_backoff(lambda: list(pool.map(lambda g: annotate_batch(api_url, *g[0]), groups)))
+            if responses is None:
+                return
+            if use_batch_route and any(resp.status_code == 404 for resp in responses):
+                # Older backend without the batch route: replan and make one call per window
+                print("Batch endpoint not found, falling back to per-window calls")
+                use_batch_route = False
+                continue
+            failed = [resp for resp in responses if resp.status_code != 200]
+            if failed:
+                print(f"Error: {_describe(failed[0])}")
+                return
+            remaining = None
+            updated = 0
+            for group, resp in zip(groups, responses):
+                data = resp.json()
+                # The batch route reports progress once per request, with per-window updates in `results`
+                for (lo, hi), window in zip(group, data['results'] if use_batch_route else [data]):
+                    print(f"Batch ids {lo}-{hi}: updated {window.get('updated_this_batch', 0)}")
+                    updated += window.get('updated_this_batch', 0)
+                # Requests finish in any order; the lowest count is the most recent
+                request_remaining = data.get('remaining_untagged', 0)
+                remaining = request_remaining if remaining is None else min(remaining, request_remaining)
+            print(f"Remaining untagged: {remaining}")
+            if remaining == 0:
+                print("All images have been annotated.")
+                break
+            pass_updated += updated
+            after_id = plan['after_id']
+            # Keep going without pause while batches are tagging photos; only idle between empty rounds
+            if updated == 0:
+                time.sleep(interval_sec)
 
 if __name__ == "__main__":
     annotate_all_batches(
         api_url="https://photoportfolio-backend-839093975626.us-central1.run.app/api/annotate-locations",
         batch_size=10,
-        interval_sec=60
+        interval_sec=1,
+        concurrency=4,
+        batches_per_request=5
     )
@@ -0,0 +1,18 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def pooled_session(pool_size=16, retries=3):
+    """
+    Build a requests.Session that keeps up to pool_size connections per host alive
+    and retries 502/503/504 up to `retries` times with backoff. The final failed
+    response is returned rather than raised, so callers keep their own status checks.
+    Only idempotent methods are retried (urllib3's default); POSTs are sent once.
+    Pass retries=0 when the caller runs its own backoff loop.
+    """
+    retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
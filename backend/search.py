@@ -1,12 +1,27 @@
 import os
+import threading
+import time
+
 import requests
 from flask import Blueprint, request, jsonify
 
+from http_session import pooled_session
+
 search_bp = Blueprint('search', __name__)
 
 GOOGLE_API_KEY = os.environ.get('GOOGLE_CUSTOM_SEARCH_API_KEY')
 GOOGLE_CSE_ID = os.environ.get('GOOGLE_CUSTOM_SEARCH_CX')
 
+# Shared session so repeat searches reuse the pooled TLS connection to googleapis.com
+_http = pooled_session()
+
+# CSE results for a query are stable for minutes, so repeats are served from memory;
+# dict insertion order doubles as the eviction order once the cache is full
+SEARCH_CACHE_TTL = 600  # seconds
+SEARCH_CACHE_MAX = 1024
+_search_cache = {}
+_search_cache_lock = threading.Lock()
+
 @search_bp.route('/api/web-search', methods=['GET'])
 def web_search():
     query = request.args.get('q')
@@ -14,13 +29,28 @@ def web_search():
         return jsonify({'error': 'Missing query parameter'}), 400
     if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
         return jsonify({'error': 'API key or CSE ID not set'}), 500
+    now = time.monotonic()
+    with _search_cache_lock:
+        hit = _search_cache.get(query)
+    if hit and hit[0] > now:
+        return jsonify(hit[1])
     url = 'https://www.googleapis.com/customsearch/v1'
     params = {
         'key': GOOGLE_API_KEY,
         'cx': GOOGLE_CSE_ID,
         'q': query
     }
-    resp = requests.get(url, params=params)
+    try:
+        resp = _http.get(url, params=params, timeout=5)
+    except requests.RequestException as e:
+        # Timeouts and connection errors get the same 502 as an upstream error status
+        return jsonify({'error': 'Google API error', 'details': str(e)}), 502
     if resp.status_code != 200:
         return jsonify({'error': 'Google API error', 'details': resp.text}), 502
-    return jsonify(resp.json())
+    results = resp.json()
+    with _search_cache_lock:
+        _search_cache.pop(query, None)
+        if len(_search_cache) >= SEARCH_CACHE_MAX:
+            del _search_cache[next(iter(_search_cache))]
+        _search_cache[query] = (now + SEARCH_CACHE_TTL, results)
+    return jsonify(results)
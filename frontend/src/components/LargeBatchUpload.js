@@ -21,6 +21,7 @@ export default function LargeBatchUpload({ onUploaded }) {
     setUploading(true);
     setError(null);
     let newProgress = {};
+    const uploaded = [];
     for (const file of files) {
       try {
         // 1. Request a signed URL for this file
@@ -37,7 +38,7 @@ export default function LargeBatchUpload({ onUploaded }) {
           }
         );
         if (!res.ok) throw new Error(`Failed to get signed URL for ${file.name}`);
-        const { url, publicUrl } = await res.json();
+        const { url, publicUrl, gcsPath } = await res.json();
         // 2. Upload the file directly to GCS
         await new Promise((resolve, reject) => {
           const xhr = new window.XMLHttpRequest();
@@ -61,23 +62,31 @@ export default function LargeBatchUpload({ onUploaded }) {
           xhr.onerror = () => reject(new Error(`Network error uploading ${file.name}`));
           xhr.send(file);
         });
-        // 3. Notify backend to register the file
-        await fetch(
-          `https://photoportfolio-backend-839093975626.us-central1.run.app/api/register-upload`,
+        uploaded.push({
+          filename: file.name,
+          contentType: file.type,
+          publicUrl,
+          gcsPath,
+        });
+      } catch (err) {
+        newProgress[file.name] = -1;
+        setProgress({ ...newProgress });
+        setError(err.message);
+      }
+    }
+    // 3. Register all uploaded files with the backend in one request
+    if (uploaded.length) {
+      try {
+        const res = await fetch(
+          `https://photoportfolio-backend-839093975626.us-central1.run.app/api/register-uploads`,
           {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-              filename: file.name,
-              contentType: file.type,
-              folder,
-              publicUrl,
-            }),
+            body: JSON.stringify({ folder, files: uploaded }),
           }
         );
+        if (!res.ok) throw new Error("Failed to register uploaded files");
       } catch (err) {
-        newProgress[file.name] = -1;
-        setProgress({ ...newProgress });
         setError(err.message);
       }
     }